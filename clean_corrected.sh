@@ -2,3 +2,4 @@
 
 rm data/**/**/**/**/temp.tif
 rm data/**/**/**/**/color_corrected.tif
+rm data/**/**/**/**/*.done
@@ -1,4 +0,0 @@
-#!/bin/bash
-
-rm data/**/**/**/**/*-projected.tif
-./clean_rgb.sh
@@ -1,4 +1,4 @@
 #!/bin/bash
 
-rm data/**/**/**/**/merged.tif
+rm data/**/**/**/**/crop.tif
 ./clean_corrected.sh
@@ -1,83 +1,255 @@
 #!/usr/bin/env python
 
-from lxml import etree
-from lxml.cssselect import CSSSelector
+from bisect import bisect_right
+import hashlib
+import os
+import time
+from xml.parsers import expat
+
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+NS = 'http://upe.ldcm.usgs.gov/schema/metadata'
+
+# expat reports namespaced names as "<uri> <local name>"
+_METADATA_TAG = '%s metaData' % NS
+_SCENE_ID_TAG = '%s sceneID' % NS
+_CLOUD_COVER_TAG = '%s cloudCoverFull' % NS
+
+_READ_SIZE = 64 * 1024
+
+# Seconds before a cached response is fetched again, so new scenes appear
+_CACHE_EXPIRY = 24 * 60 * 60
+
+# EarthExplorer dataset for years from each boundary up to the next one
+_DATASET_BOUNDS = (1972, 1984, 1999, 2003, 2013)
+_DATASET_NAMES = (
+    None,
+    # Landsat 1-4
+    'LANDSAT_MSS1',
+    # Landsat 5
+    'LANDSAT_COMBINED',
+    # Landsat 7
+    'LANDSAT_ETM',
+    # Landsat 5 for broken years of Landsat 7
+    'LANDSAT_COMBINED',
+    # Landsat 8
+    'LANDSAT_8'
+)
+
+
+class _MetadataHandler(object):
+    """
+    expat callbacks that collect ``(scene_id, cloud_cover)`` pairs as each
+    ``metaData`` element closes. Only the text of the two fields of interest
+    is buffered.
+    """
+    def __init__(self):
+        self.root = None
+        self.records = []
+        self._fields = {}
+        self._field = None
+        self._text = []
+
+    def start(self, name, attrs):
+        if self.root is None:
+            self.root = name
+
+        if name == _SCENE_ID_TAG or name == _CLOUD_COVER_TAG:
+            self._field = name
+            self._text = []
+
+    def data(self, text):
+        if self._field is not None:
+            self._text.append(text)
+
+    def end(self, name):
+        if name == self._field:
+            self._fields[name] = ''.join(self._text)
+            self._field = None
+        elif name == _METADATA_TAG:
+            scene_id = self._fields.get(_SCENE_ID_TAG)
+            cloud_cover = self._fields.get(_CLOUD_COVER_TAG, '').strip()
+
+            # A scene without a cloud cover reading is treated as fully cloudy,
+            # so it never passes the filter by accident
+            if cloud_cover:
+                cloud_cover = float(cloud_cover)
+            else:
+                cloud_cover = 100.0
+
+            if scene_id is not None:
+                self.records.append((scene_id, cloud_cover))
+
+            self._fields = {}
+
+
+class _CopyingReader(object):
+    """
+    File-like wrapper that writes everything read from ``source`` to
+    ``copy``, so a response can be parsed and saved in one pass.
+    """
+    def __init__(self, source, copy):
+        self.source = source
+        self.copy = copy
+
+    def read(self, size):
+        chunk = self.source.read(size)
+        self.copy.write(chunk)
+
+        return chunk
+
+
+def _build_session():
+    """
+    Create a keep-alive session that retries transient server errors.
+    """
+    retries = Retry(total=5, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=retries)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+
+    return session
 
 
 class EarthExplorer(object):
     """
     Search USGS EarthExplorer for scene identifiers.
+
+    Scenes are searched either by WRS ``path`` and ``row`` or, if given, by a
+    ``bounding_box`` of ``(north, west, south, east)`` coordinates.
     """
-    def __init__(self, year, path, row, max_cloud_cover=0):
+    #: Shared across instances so concurrent queries reuse pooled connections
+    session = _build_session()
+
+    def __init__(self, year, path=None, row=None, max_cloud_cover=0, cache_dir='data/.cache', bounding_box=None):
+        if bounding_box is None and (path is None or row is None):
+            raise ValueError('Either a path and row or a bounding box is required.')
+
         self.year = year
         self.path = path
         self.row = row
         self.max_cloud_cover = max_cloud_cover
+        self.cache_dir = cache_dir
+        self.bounding_box = bounding_box
 
     def _get_dataset_name(self):
         """
         Get the correct EarthExplorer dataset name for the given year.
         """
-        # Landsat 8
-        if self.year >= 2013:
-            return 'LANDSAT_8'
-        # Landsat 5 for broken years of Landsat 7
-        elif self.year >= 2003:
-            return 'LANDSAT_COMBINED'
-        # Landsat 7
-        elif self.year >= 1999:
-            return 'LANDSAT_ETM'
-        # Landsat 5
-        elif self.year >= 1984:
-            return 'LANDSAT_COMBINED'
-        # Landsat 1-4
-        elif self.year >= 1972:
-            return 'LANDSAT_MSS1'
-        else:
+        name = _DATASET_NAMES[bisect_right(_DATASET_BOUNDS, self.year)]
+
+        if name is None:
             raise ValueError('Landsat 1 did not come online until 1972.')
 
-    def get_scenes(self):
+        return name
+
+    def _get_url(self):
         """
-        Fetch a scene list from the EarthExplorer API. Individual scenes are
-        parsed and returned as :class:`.SceneID` instances.
+        Build the inventory query URL for this search.
         """
-        url = 'http://earthexplorer.usgs.gov/EE/InventoryStream/pathrow?start_path={path}&end_path={path}&start_row={row}&end_row={row}&sensor={sensor}&start_date={year}-01-01&end_date={year}-12-31'.format(
+        if self.bounding_box is not None:
+            north, west, south, east = self.bounding_box
+
+            return 'http://earthexplorer.usgs.gov/EE/InventoryStream/latlong?north={north}&south={south}&east={east}&west={west}&sensor={sensor}&start_date={year}-01-01&end_date={year}-12-31'.format(
+                north=north,
+                south=south,
+                east=east,
+                west=west,
+                sensor=self._get_dataset_name(),
+                year=self.year
+            )
+
+        return 'http://earthexplorer.usgs.gov/EE/InventoryStream/pathrow?start_path={path}&end_path={path}&start_row={row}&end_row={row}&sensor={sensor}&start_date={year}-01-01&end_date={year}-12-31'.format(
             path=self.path,
             row=self.row,
             sensor=self._get_dataset_name(),
             year=self.year
         )
+
+    def get_scenes(self):
+        """
+        Fetch a scene list from the EarthExplorer API.
+
+        Responses are cached in ``cache_dir`` for a day so repeated runs do
+        not hit the network for queries they have just made. Cached scene ids
+        are yielded as they are parsed, so callers that only want the first
+        few can stop without reading the rest of the response.
+        """
+        url = self._get_url()
         print(url)
 
-        r = requests.get(url)
-        content = r.content
-        xml = etree.fromstring(content)
+        cache_path = os.path.join(self.cache_dir, '%s.xml' % hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+        if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= time.time() - _CACHE_EXPIRY:
+            with open(cache_path, 'rb') as f:
+                for scene_id in self._iter_scenes(f):
+                    yield scene_id
+        else:
+            for scene_id in self._download(url, cache_path):
+                yield scene_id
+
+    def _download(self, url, path):
+        """
+        Stream a response body to disk, parsing it on the way, and return the
+        ids of the scenes that pass the cloud cover filter. The file is
+        written under a temporary name and only renamed into place once it
+        has parsed, so an interrupted download or an unexpected body is never
+        mistaken for a cached response.
+        """
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError:
+            # Another thread may have created it first
+            if not os.path.isdir(self.cache_dir):
+                raise
 
-        def cssselect(el, css):
-            selector = CSSSelector('ns|%s' % css, namespaces={ 'ns': 'http://upe.ldcm.usgs.gov/schema/metadata' })
+        r = self.session.get(url, stream=True, timeout=30)
+        r.raise_for_status()
+        r.raw.decode_content = True
 
-            return selector(el)
+        tmp_path = '%s.tmp' % path
 
-        def cloud_filter(metadata):
-            scene_id = cssselect(metadata, 'sceneID')[0].text
-            cloud_cover_el = cssselect(metadata, 'cloudCoverFull')[0]
+        try:
+            with open(tmp_path, 'wb') as f:
+                scene_ids = list(self._iter_scenes(_CopyingReader(r.raw, f)))
+        except Exception:
+            os.remove(tmp_path)
+            raise
 
-            value = float(cloud_cover_el.text)
+        os.rename(tmp_path, path)
 
-            if value > self.max_cloud_cover:
-                print('Skipping %s, %.0f%% cloud cover' % (scene_id, value))
-                return False
+        return scene_ids
 
-            return True
+    def _iter_scenes(self, f):
+        """
+        Incrementally parse an EarthExplorer response, yielding the ids of
+        scenes that pass the cloud cover filter. The response is fed to expat
+        in chunks, so no document tree is ever built.
+        """
+        handler = _MetadataHandler()
 
-        def get_scene_id(metadata):
-            scene_id_el = cssselect(metadata, 'sceneID')[0]
+        parser = expat.ParserCreate(namespace_separator=' ')
+        parser.StartElementHandler = handler.start
+        parser.CharacterDataHandler = handler.data
+        parser.EndElementHandler = handler.end
 
-            return scene_id_el.text
+        while True:
+            chunk = f.read(_READ_SIZE)
+            parser.Parse(chunk, not chunk)
 
-        metadata = cssselect(xml, 'metaData')
-        cloudless = filter(cloud_filter, metadata)
-        scene_ids = map(get_scene_id, cloudless)
+            for scene_id, value in handler.records:
+                if value > self.max_cloud_cover:
+                    print('Skipping %s, %.0f%% cloud cover' % (scene_id, value))
+                else:
+                    yield scene_id
 
-        return scene_ids
+            del handler.records[:]
+
+            if not chunk:
+                break
+
+        if handler.root is None or not handler.root.startswith('%s ' % NS):
+            raise ValueError('Unexpected EarthExplorer response')
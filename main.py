@@ -6,8 +6,12 @@ Spectral band definitions: http://landsat.usgs.gov//band_designations_landsat_sa
 Band usages: http://landsat.usgs.gov//best_spectral_bands_to_use.php
 """
 
+from collections import OrderedDict
 from glob import glob
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
 import os
+from subprocess import CalledProcessError
 import sys
 import yaml
 
@@ -15,15 +19,16 @@ import rasterio
 from rasterio.tools.merge import merge
 
 from earthexplorer import EarthExplorer
-from scene import Scene
+from scene import Scene, SceneID, done_marker_path, thread_options
 
 
-def merge_adjacent(path_dir):
+def merge_adjacent(path_dir, threads):
     print('Merging adjacent images')
 
     output_path = '%s/merged.tif' % path_dir
+    gdal_options, creation_options = thread_options(threads)
 
-    with rasterio.drivers():
+    with rasterio.drivers(**gdal_options):
         files = glob('%s/**/**/color_corrected.tif' % path_dir)
 
         sources = [rasterio.open(f) for f in files]
@@ -34,11 +39,31 @@ def merge_adjacent(path_dir):
         profile['transform'] = output_transform
         profile['height'] = dest.shape[1]
         profile['width'] = dest.shape[2]
-        profile['driver'] = 'GTiff'
+        profile.update(creation_options)
 
         with rasterio.open(output_path, 'w', **profile) as dst:
             dst.write(dest)
 
+        for source in sources:
+            source.close()
+
+
+def _merge_task(args):
+    return merge_adjacent(*args)
+
+
+def download_scene(scene):
+    """
+    Download a scene ahead of processing. Failures are left for
+    :meth:`.Scene.process` to retry and report.
+    """
+    try:
+        scene.download()
+    except CalledProcessError as e:
+        print(str(e))
+
+    return scene
+
 
 def main():
     output_dir = 'data'
@@ -46,32 +71,90 @@ def main():
     with open(sys.argv[1]) as f:
         config = yaml.load(f)
 
-    for year in range(config['start_year'], config['end_year'] + 1):
-        print(year)
-        year_dir = os.path.join(output_dir, str(year))
+    years = range(config['start_year'], config['end_year'] + 1)
+
+    # Configs give either a range of WRS paths and rows or a bounding box
+    if 'path_start' in config:
+        paths = range(config['path_start'], config['path_end'] + 1)
+        rows = range(config['row_start'], config['row_end'] + 1)
+
+        searches = [
+            (year, {'path': path, 'row': row})
+            for year in years for path in paths for row in rows
+        ]
+    else:
+        bounding_box = (config['north'], config['west'], config['south'], config['east'])
+
+        searches = [(year, {'bounding_box': bounding_box}) for year in years]
+
+    def get_scenes(search):
+        year, location = search
+        explorer = EarthExplorer(year, max_cloud_cover=config['max_cloud_cover'], **location)
+
+        # Only the first cloudless scene of each path and row is processed
+        first_scenes = OrderedDict()
+
+        for scene_id in explorer.get_scenes():
+            scene_id = SceneID(scene_id)
+            first_scenes.setdefault((scene_id.path, scene_id.row), scene_id)
+
+            # A path and row search has only one, so stop parsing there
+            if 'bounding_box' not in location:
+                break
+
+        return list(first_scenes.values())
+
+    pool = ThreadPool(16)
+    results = pool.map(get_scenes, searches)
+    pool.close()
+    pool.join()
+
+    queued = []
+    path_dirs = []
+
+    for (year, location), scene_ids in zip(searches, results):
+        for scene_id in scene_ids:
+            path_dir = os.path.join(output_dir, str(year), str(int(scene_id.path)))
+            scene_dir = os.path.join(path_dir, str(int(scene_id.row)), scene_id)
+
+            if path_dir not in path_dirs:
+                path_dirs.append(path_dir)
+
+            if os.path.exists(done_marker_path(scene_dir, scene_id)):
+                print('Skipping %s, already processed' % scene_id)
+                continue
+
+            print('Processing %s' % scene_id)
 
-        for path in range(config['path_start'], config['path_end'] + 1):
-            path_dir = os.path.join(year_dir, str(path))
-            print(path)
+            queued.append(Scene(scene_id, scene_dir, config.get('levels'), config.get('cutline')))
 
-            for row in range(config['row_start'], config['row_end'] + 1):
-                row_dir = os.path.join(path_dir, str(row))
-                print(row)
+    # Downloads are network bound and processing is CPU bound, so hand each
+    # scene to the processing pool as soon as its download finishes. The
+    # processing workers are forked before any download threads start.
+    process_pool = Scene.create_pool(config.get('workers'))
+    download_pool = ThreadPool(8)
 
-                explorer = EarthExplorer(year, path, row, max_cloud_cover=config['max_cloud_cover'])
-                scene_ids = explorer.get_scenes()
+    Scene.process_many(download_pool.imap_unordered(download_scene, queued), process_pool)
 
-                for scene_id in scene_ids[:1]:
-                    print('Processing %s' % scene_id)
+    download_pool.close()
+    download_pool.join()
+    process_pool.close()
+    process_pool.join()
 
-                    scene_dir = os.path.join(row_dir, scene_id)
-                    scene = Scene(scene_id, scene_dir, config['levels'], config['cutline'])
-                    scene.process()
+    # Each path is mosaicked independently, so merge them in parallel
+    merge_dirs = [
+        path_dir for path_dir in path_dirs
+        if len(glob('%s/**/**/color_corrected.tif' % path_dir)) > 0
+    ]
 
-            files = glob('%s/**/**/color_corrected.tif' % path_dir)
+    # Split the cores between the merges running at once
+    workers = max(1, min(cpu_count(), len(merge_dirs)))
+    threads = max(1, cpu_count() // workers)
 
-            if len(files) > 0:
-                merge_adjacent(path_dir)
+    merge_pool = Pool(workers)
+    merge_pool.map(_merge_task, [(path_dir, threads) for path_dir in merge_dirs])
+    merge_pool.close()
+    merge_pool.join()
 
 
 if __name__ == '__main__':
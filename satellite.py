@@ -1,5 +1,26 @@
 #!/usr/bin/env python
 
+from bisect import bisect_right
+
+_SENSORS = {1: 'M', 2: 'M', 3: 'M', 4: 'T', 5: 'T', 7: 'E', 8: 'C'}
+
+_NATURAL_COLOR_BANDS = {4: (3, 2, 1), 5: (3, 2, 1), 7: (3, 2, 1), 8: (4, 3, 2)}
+
+_URBAN_FALSE_COLOR_BANDS = {4: (7, 5, 3), 5: (7, 5, 3), 7: (7, 5, 3), 8: (7, 6, 4)}
+
+_VEGETATION_FALSE_COLOR_BANDS = {
+    1: (6, 5, 4), 2: (6, 5, 4), 3: (6, 5, 4),
+    4: (4, 3, 2), 5: (4, 3, 2), 7: (4, 3, 2),
+    8: (5, 4, 3)
+}
+
+# Preferred version for years from each boundary up to the next one. Landsat 7
+# is only used until its scan line corrector failed in 2003.
+_YEAR_BOUNDS = (1982, 1984, 1999, 2003, 2013)
+_YEAR_VERSIONS = (None, 4, 5, 7, 5, 8)
+
+_INSTANCES = {}
+
 
 class Satellite(object):
     """
@@ -11,18 +32,16 @@ class Satellite(object):
         elif version > 8:
             raise ValueError('Landsat 8 is the highest active version.')
 
+        try:
+            self.sensor = _SENSORS[version]
+        except KeyError:
+            raise ValueError('Landsat %s is not a known version.' % version)
+
         self.version = version
 
-    @property
-    def sensor(self):
-        if self.version == 8:
-            return 'C'
-        elif self.version == 7:
-            return 'E'
-        elif self.version >= 4:
-            return 'T'
-        else:
-            return 'M'
+        # 5-4-3 color infrared for analyzing vegetation.
+        # http://www.exelisvis.com/Home/NewsUpdates/TabId/170/ArtMID/735/ArticleID/14305/The-Many-Band-Combinations-of-Landsat-8.aspx
+        self.vegetation_false_color_bands = _VEGETATION_FALSE_COLOR_BANDS[version]
 
     @property
     def natural_color_bands(self):
@@ -31,10 +50,8 @@ class Satellite(object):
         """
         if self.version < 4:
             raise ValueError('True color is not possible for Landsats 1-3 as they did not have a blue band.')
-        elif self.version < 8:
-            return [3, 2, 1]
-        else:
-            return [4, 3, 2]
+
+        return _NATURAL_COLOR_BANDS[self.version]
 
     @property
     def urban_false_color_bands(self):
@@ -45,43 +62,31 @@ class Satellite(object):
         """
         if self.version < 4:
             raise ValueError('Urban false color is not possible for Landsats 1-3 as they did not have short-wave infrared bands.')
-        elif self.version < 8:
-            return [7, 5, 3]
-        else:
-            return [7, 6, 4]
 
-    @property
-    def vegetation_false_color_bands(self):
-        """
-        5-4-3 color infrared for analyzing vegetation.
+        return _URBAN_FALSE_COLOR_BANDS[self.version]
 
-        http://www.exelisvis.com/Home/NewsUpdates/TabId/170/ArtMID/735/ArticleID/14305/The-Many-Band-Combinations-of-Landsat-8.aspx
+    @classmethod
+    def for_version(cls, version):
         """
-        if self.version < 4:
-            return [6, 5, 4]
-        elif self.version < 8:
-            return [4, 3, 2]
-        else:
-            return [5, 4, 3]
+        Get the shared configuration for a given version. Only a handful of
+        versions exist, so each is built once and reused.
+        """
+        try:
+            return _INSTANCES[(cls, version)]
+        except KeyError:
+            satellite = _INSTANCES[(cls, version)] = cls(version)
+
+            return satellite
 
     @classmethod
     def for_year(cls, year):
         """
         Get the preferred satellite configuration for a given year.
         """
-        if year >= 2013:
-            return cls(8)
-        elif year >= 1999 and year < 2003:
-            return cls(7)
-        elif year >= 1984:
-            return cls(5)
-        elif year >= 1982:
-            return cls(4)
-        # elif year >= 1978:
-        #     return cls(3)
-        # elif year >= 1975:
-        #     return cls(2)
-        # else:
-        #     return cls(1)
-        else:
+        # Landsats 1-3 are excluded: years before 1982 map to None
+        version = _YEAR_VERSIONS[bisect_right(_YEAR_BOUNDS, year)]
+
+        if version is None:
             raise ValueError('Only years starting in 1982 are allowed (due to change in WVS coordinates).')
+
+        return cls.for_version(version)
@@ -1,62 +1,194 @@
 #!/usr/bin/env python
 
-from glob import glob
+from multiprocessing import Pool, cpu_count
 import os
+import shutil
+import signal
+from subprocess import CalledProcessError, PIPE, Popen, check_call
+import tarfile
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
 
-from invoke import run
-from invoke.exceptions import Failure
 import numpy as np
 import rasterio
 from skimage import exposure, img_as_ubyte
 
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
 from satellite import Satellite
 
+DST_CRS = 'EPSG:3857'
+
+# Buffer size for reading scene archives
+_READ_SIZE = 1024 * 1024
+
+# Parallel decompressors to try, by the archive's leading magic bytes
+_DECOMPRESSORS = (
+    (b'\x1f\x8b', ('pigz',)),
+    (b'BZh', ('lbzip2', 'pbzip2')),
+)
+
+# Rough peak memory of one scene worker: a whole uncropped scene equalized
+# in float64, plus GDAL's block cache and warp buffer
+_WORKER_MEMORY = 6 * 1024 ** 3
+
+# GDAL settings for every raster step
+GDAL_OPTIONS = {
+    'GDAL_CACHEMAX': 1024,
+    'GDAL_NUM_THREADS': 'ALL_CPUS',
+}
+
+# Tiled, compressed layout for every GeoTIFF written, so later stages read
+# whole blocks instead of strips
+CREATION_OPTIONS = {
+    'driver': 'GTiff',
+    'tiled': True,
+    'blockxsize': 512,
+    'blockysize': 512,
+    'compress': 'deflate',
+    'num_threads': 'all_cpus',
+}
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _apply_lut(source, lut, out):
+        for i in prange(source.size):
+            out[i] = lut[source[i]]
+else:
+    def _apply_lut(source, lut, out):
+        np.take(lut, source, out=out)
+
+
+def _gdal_args(options, creation_options):
+    """
+    Translate rasterio-style settings into GDAL command line arguments.
+    """
+    args = []
 
-class SceneID(str):
+    for key, value in sorted(options.items()):
+        args.extend(['--config', key, str(value)])
+
+    for key, value in sorted(creation_options.items()):
+        if key == 'driver':
+            args.extend(['-of', value])
+        else:
+            if value is True:
+                value = 'YES'
+
+            args.extend(['-co', '%s=%s' % (key.upper(), value)])
+
+    return args
+
+
+def _restore_sigpipe():
     """
-    A Landsat scene identifier like: LT41910561988052AAA03.
+    Give a child process the default SIGPIPE handling, which Python 2 leaves
+    ignored. Decompressors then exit quietly when extraction stops early,
+    rather than reporting a broken pipe.
+    """
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
-    Naming convention is defined at:
-    http://landsat.usgs.gov/naming_conventions_scene_identifiers.php
+
+def _find_decompressor(path):
     """
-    @property
-    def sensor(self):
-        return self[1]
+    Find an installed parallel decompressor for an archive, or ``None``.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(3)
 
-    @property
-    def version(self):
-        return int(self[2])
+    for prefix, programs in _DECOMPRESSORS:
+        if magic.startswith(prefix):
+            for program in programs:
+                executable = which(program)
 
-    @property
-    def path(self):
-        return self[3:6]
+                if executable:
+                    return executable
 
-    @property
-    def row(self):
-        return self[6:9]
+    return None
 
-    @property
-    def year(self):
-        return self[9:13]
 
-    @property
-    def day(self):
-        return self[13:16]
+# Threads one scene's GDAL work may use. Worker processes lower this so
+# that together they use each core once.
+_worker_threads = cpu_count()
 
-    @property
-    def ground_station_id(self):
-        return self[16:19]
 
-    @property
-    def archive_version(self):
-        return self[19:21]
+def _default_workers():
+    """
+    Run a worker for every two cores, but no more than fit in physical
+    memory at ``_WORKER_MEMORY`` each.
+    """
+    workers = cpu_count() // 2
+
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        pass
+    else:
+        workers = min(workers, memory // _WORKER_MEMORY)
+
+    return max(1, workers)
+
+
+def _init_worker(threads):
+    global _worker_threads
+    _worker_threads = threads
+
+
+def thread_options(threads):
+    """
+    Get ``GDAL_OPTIONS`` and ``CREATION_OPTIONS`` limited to ``threads``
+    threads, for processes that share the machine with other workers.
+    """
+    return (
+        dict(GDAL_OPTIONS, GDAL_NUM_THREADS=threads),
+        dict(CREATION_OPTIONS, num_threads=threads)
+    )
+
+
+def _process_scene(scene):
+    scene.process()
+
+
+def done_marker_path(output_dir, scene_id):
+    """
+    Path of the marker file written once a scene is fully processed.
+    """
+    return os.path.join(output_dir, '%s.done' % scene_id)
+
+
+class SceneID(str):
+    """
+    A Landsat scene identifier like: LT41910561988052AAA03.
+
+    Naming convention is defined at:
+    http://landsat.usgs.gov/naming_conventions_scene_identifiers.php
+
+    The identifier's fields are sliced out once, when it is created.
+    """
+    def __new__(cls, value):
+        self = super(SceneID, cls).__new__(cls, value)
+
+        self.sensor = self[1]
+        self.version = int(self[2])
+        self.path = self[3:6]
+        self.row = self[6:9]
+        self.year = self[9:13]
+        self.day = self[13:16]
+        self.ground_station_id = self[16:19]
+        self.archive_version = self[19:21]
 
-    @property
-    def google_id(self):
         if self.version > 4:
-            return 'L%s' % self.version
+            self.google_id = 'L%s' % self.version
         else:
-            return 'L%s%i' % (self.sensor, self.version)
+            self.google_id = 'L%s%i' % (self.sensor, self.version)
+
+        return self
 
 
 class Scene(object):
@@ -69,59 +201,76 @@ class Scene(object):
         self.levels = levels
         self.cutline = cutline
 
-        self.satellite = Satellite(self.scene_id.version)
+        self.base_path = '%s/%s' % (output_dir, self.scene_id)
+        self.url = 'gs://earthengine-public/landsat/{id.google_id}/{id.path}/{id.row}/{id}.tar.bz'.format(id=self.scene_id)
+
+        self.satellite = Satellite.for_version(self.scene_id.version)
+
+        self._dir_cache = None
+        self._bands = None
 
     @property
     def bands(self):
-        long_name = '{base_path}_B10.TIF'.format(base_path=self.base_path)
+        """
+        Band names for this scene. Some archives use long names like ``B10``,
+        which is only known once the scene is unzipped, so this is cached
+        alongside the directory listing.
+        """
+        if self._bands is None:
+            long_name = '%s_B10.TIF' % self.scene_id
 
-        if os.path.exists(long_name):
-            return ['B%i0' % b for b in self.satellite.natural_color_bands]
-        else:
-            return ['B%i' % b for b in self.satellite.natural_color_bands]
+            if long_name in self._dir_entries:
+                self._bands = ['B%i0' % b for b in self.satellite.natural_color_bands]
+            else:
+                self._bands = ['B%i' % b for b in self.satellite.natural_color_bands]
 
-    @property
-    def base_path(self):
-        return '{output_dir}/{scene_id}'.format(
-            output_dir=self.output_dir,
-            scene_id=self.scene_id
-        )
+        return self._bands
 
     @property
-    def zip_exists(self):
-        tar_path = os.path.join(self.output_dir, '%s.tar.bz' % self.scene_id)
+    def _dir_entries(self):
+        """
+        Names of the files in the output directory. The directory is listed
+        once and reused until a processing step writes to it.
+        """
+        if self._dir_cache is None:
+            if os.path.isdir(self.output_dir):
+                self._dir_cache = frozenset(os.listdir(self.output_dir))
+            else:
+                self._dir_cache = frozenset()
 
-        return os.path.exists(tar_path)
+        return self._dir_cache
 
-    @property
-    def band_files_exist(self):
-        band_files = glob('%s/*_B*' % self.output_dir)
+    def _invalidate_dir_entries(self):
+        self._dir_cache = None
+        self._bands = None
 
-        return len(band_files) >= len(self.bands)
+    @property
+    def zip_exists(self):
+        return '%s.tar.bz' % self.scene_id in self._dir_entries
 
     @property
-    def projected_files_exist(self):
-        projected_files = glob('%s/*-projected.tif' % self.output_dir)
+    def band_files_exist(self):
+        prefix = '%s_B' % self.scene_id
+        needed = len(self.bands)
+        found = 0
 
-        return len(projected_files) >= len(self.bands)
+        # Stop as soon as enough band files have been seen
+        for name in self._dir_entries:
+            if name.startswith(prefix):
+                found += 1
 
-    @property
-    def merged_file_exists(self):
-        merged_file = '%s/merged.tif' % self.output_dir
+                if found >= needed:
+                    return True
 
-        return os.path.exists(merged_file)
+        return False
 
     @property
     def color_corrected_file_exists(self):
-        color_corrected_file = '%s/color_corrected.tif' % self.output_dir
-
-        return os.path.exists(color_corrected_file)
+        return 'color_corrected.tif' in self._dir_entries
 
     @property
     def crop_file_exists(self):
-        crop_file = '%s/crop.tif' % self.output_dir
-
-        return os.path.exists(crop_file)
+        return 'crop.tif' in self._dir_entries
 
     def download(self):
         """
@@ -133,12 +282,12 @@ class Scene(object):
         if not os.path.exists(self.output_dir):
             os.makedirs(self.output_dir)
 
-        url = 'gs://earthengine-public/landsat/{id.google_id}/{id.path}/{id.row}/{id}.tar.bz'.format(id=self.scene_id)
+        cmd = ['gsutil', 'cp', self.url, self.output_dir]
 
-        cmd = 'gsutil cp %s %s' % (url, self.output_dir)
+        print(' '.join(cmd))
+        check_call(cmd)
 
-        print(cmd)
-        run(cmd)
+        self._invalidate_dir_entries()
 
     def unzip(self):
         """
@@ -150,85 +299,132 @@ class Scene(object):
         if self.band_files_exist:
             return
 
-        cmd = 'cd %s && tar --transform \'s/^.*_/%s_/g\' -xzvf %s.tar.bz' % (
-            self.output_dir, self.scene_id, self.scene_id
-        )
+        archive_path = '%s.tar.bz' % self.base_path
+        band_numbers = self.satellite.natural_color_bands
 
-        print(cmd)
-        run(cmd)
+        # Archives name bands either ``B4`` or ``B40``
+        wanted = {}
 
-    def _convert_to_8bit(self, band):
-        cmd = 'gdal_translate -of "GTiff" -co "COMPRESS=LZW" -scale 0 65535 0 255 -ot Byte {base_path}_{band}.TIF {base_path}_{band}_tmp.TIF'.format(
-            base_path=self.base_path,
-            band=band
-        )
+        for b in band_numbers:
+            wanted['B%i.TIF' % b] = b
+            wanted['B%i0.TIF' % b] = b
 
-        print(cmd)
-        run(cmd)
+        # Decompression is the slow part, so hand it to a multi-threaded
+        # decompressor when one is installed
+        decompressor = _find_decompressor(archive_path)
 
-        cmd = 'rm {base_path}_{band}.TIF && mv {base_path}_{band}_tmp.TIF {base_path}_{band}.TIF'.format(
-            base_path=self.base_path,
-            band=band
-        )
+        if decompressor is None:
+            print('Extracting %s' % archive_path)
 
-        print(cmd)
-        run(cmd)
+            process = None
+            tar = tarfile.open(archive_path, 'r|*', bufsize=_READ_SIZE)
+        else:
+            cmd = [decompressor, '-dc', archive_path]
 
-    def project_bands(self):
-        if not self.band_files_exist:
-            raise IOError('Band files do not exist!')
+            print(' '.join(cmd))
 
-        if self.projected_files_exist:
-            return
+            process = Popen(cmd, stdout=PIPE, bufsize=_READ_SIZE, preexec_fn=_restore_sigpipe)
+            tar = tarfile.open(fileobj=process.stdout, mode='r|', bufsize=_READ_SIZE)
 
-        for band in self.bands:
-            if self.satellite.version > 7:
-                self._convert_to_8bit(band)
+        extracted = set()
 
-            base_file_path = '{base_path}_{band}'.format(
-                base_path=self.base_path,
-                band=band,
-            )
-            cmd = 'gdalwarp -t_srs "EPSG:3857" {base_file_path}.TIF {base_file_path}-projected.tif'.format(
-                base_file_path=base_file_path,
-                cutline=self.cutline
-            )
+        # The archive is read as a stream, so stop once the last band is out
+        # rather than decompressing the rest of it
+        try:
+            for member in tar:
+                if not member.isfile():
+                    continue
 
-            print(cmd)
-            run(cmd)
+                suffix = os.path.basename(member.name).rsplit('_', 1)[-1]
 
-    def merge_bands(self):
-        if not self.projected_files_exist:
-            raise IOError('Projected band files do not exist!')
+                if suffix not in wanted:
+                    continue
 
-        if self.merged_file_exists:
-            return
+                band_path = '%s_%s' % (self.base_path, suffix)
+                tmp_path = '%s/.%s_%s.tmp' % (self.output_dir, self.scene_id, suffix)
 
-        bands = ','.join(self.bands)
+                source = tar.extractfile(member)
 
-        cmd = 'rio stack {base_path}_{{{bands}}}-projected.tif -o {output_dir}/merged.tif'.format(
-            base_path=self.base_path,
-            bands=bands,
-            output_dir=self.output_dir
-        )
+                with open(tmp_path, 'wb') as f:
+                    shutil.copyfileobj(source, f, _READ_SIZE)
 
-        print(cmd)
-        run(cmd)
+                os.rename(tmp_path, band_path)
+                extracted.add(wanted[suffix])
 
-    def crop(self):
-        if not self.merged_file_exists:
-            raise IOError('Merged file does not exist')
+                if len(extracted) == len(band_numbers):
+                    break
+        finally:
+            tar.close()
+
+            if process is not None:
+                process.stdout.close()
+                process.wait()
+
+        self._invalidate_dir_entries()
+
+        # Stopping early closes the pipe on the decompressor, so its exit
+        # status only matters if some bands never arrived
+        if process is not None and process.returncode and len(extracted) < len(band_numbers):
+            raise CalledProcessError(process.returncode, cmd)
+
+    def project_bands(self):
+        """
+        Stack the bands in a VRT and reproject it in one ``gdalwarp`` call,
+        cropped to the cutline if there is one, straight into ``crop.tif``.
+        GDAL reads the cutline, so any format and CRS it supports can be used.
+        """
+        if not self.band_files_exist:
+            raise IOError('Band files do not exist!')
 
         if self.crop_file_exists:
             return
 
-        cmd = 'gdalwarp -cutline {cutline} -crop_to_cutline {output_dir}/merged.tif {output_dir}/crop.tif'.format(
-            cutline=self.cutline,
-            output_dir=self.output_dir
-        )
+        stack_path = '%s/stack.vrt' % self.output_dir
+        scaled_path = '%s/stack-8bit.vrt' % self.output_dir
+        crop_path = '%s/crop.tif' % self.output_dir
+        tmp_path = '%s/.crop.tif.tmp' % self.output_dir
+
+        band_paths = ['%s_%s.TIF' % (self.base_path, band) for band in self.bands]
+
+        commands = [
+            ['gdalbuildvrt', '-separate', stack_path] + band_paths
+        ]
+
+        # Landsat 8 bands are 16-bit: scale 0-65535 to 0-255 in another VRT,
+        # so the pixels are only touched once, by the warp
+        if self.satellite.version > 7:
+            commands.append([
+                'gdal_translate', '-of', 'VRT', '-ot', 'Byte',
+                '-scale', '0', '65535', '0', '255', stack_path, scaled_path
+            ])
+            warp_source = scaled_path
+        else:
+            warp_source = stack_path
+
+        warp = ['gdalwarp', '-overwrite', '-t_srs', DST_CRS]
+
+        if self.cutline is not None:
+            warp.extend(['-cutline', self.cutline, '-crop_to_cutline'])
+
+        warp.extend(['-multi', '-wo', 'NUM_THREADS=%i' % _worker_threads, '-wm', '512'])
+        warp.extend(_gdal_args(*thread_options(_worker_threads)))
+        warp.extend([warp_source, tmp_path])
+
+        commands.append(warp)
 
-        print(cmd)
-        run(cmd)
+        try:
+            for cmd in commands:
+                print(' '.join(cmd))
+                check_call(cmd)
+
+            # Only a finished warp is seen as crop.tif
+            os.rename(tmp_path, crop_path)
+        finally:
+            for path in (stack_path, scaled_path, tmp_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        self._invalidate_dir_entries()
 
     def hist_match(self, source, template):
         """
@@ -252,14 +448,17 @@ class Scene(object):
         source = source.ravel()
         template = template.ravel()
 
-        # get the set of unique pixel values and their corresponding indices and
-        # counts
-        s_values, bin_idx, s_counts = np.unique(source, return_inverse=True,
-                                                return_counts=True)
-        t_values, t_counts = np.unique(template, return_counts=True)
+        # count each 8-bit pixel value; a fixed 256-bin histogram avoids
+        # sorting the whole image the way np.unique would
+        s_counts = np.bincount(source, minlength=256)
+        t_counts = np.bincount(template, minlength=256)
+
+        # only the template values that actually occur are interpolation points
+        t_values = np.flatnonzero(t_counts)
+        t_counts = t_counts[t_values]
 
-        s_counts[0] = 0
-        print(t_counts)
+        # drop the lowest value present, as the np.unique version did
+        s_counts[np.flatnonzero(s_counts)[0]] = 0
 
         # take the cumsum of the counts and normalize by the number of pixels to
         # get the empirical cumulative distribution functions for the source and
@@ -278,9 +477,11 @@ class Scene(object):
         # # that correspond most closely to the quantiles in the source image
         interp_t_values = np.interp(s_quantiles, t_quantiles, t_values).astype(np.ubyte)
 
-        print interp_t_values
+        # interp_t_values is a 256-entry lookup table indexed by pixel value
+        matched = np.empty_like(source)
+        _apply_lut(source, interp_t_values, matched)
 
-        return interp_t_values[bin_idx].reshape(oldshape)
+        return matched.reshape(oldshape)
 
         # return out.reshape(oldshape)
 
@@ -293,15 +494,17 @@ class Scene(object):
 
         print('Equalizing histograms')
 
-        with rasterio.drivers():
-            with rasterio.open('correct.tif') as f:
-                template = np.rollaxis(np.rollaxis(f.read(), 1), 2, 1)
+        gdal_options, creation_options = thread_options(_worker_threads)
 
+        with rasterio.drivers(**gdal_options):
+            # (bands, rows, cols) to the channel-last layout skimage expects,
+            # copied once into contiguous memory. The band-first read is
+            # released straight away rather than held through equalization.
             with rasterio.open('%s/crop.tif' % self.output_dir) as f:
-                data = f.read()
+                rolled = np.ascontiguousarray(np.moveaxis(f.read(), 0, -1))
                 profile = f.profile
 
-            rolled = np.rollaxis(np.rollaxis(data, 1), 2, 1)
+            profile.update(creation_options)
 
             # new_bands = []
             #
@@ -322,28 +525,73 @@ class Scene(object):
             #
             # rescaled = np.array(new_bands).T
 
+            # with rasterio.open('correct.tif') as f:
+            #     template = np.moveaxis(f.read(), 0, -1)
+            #
             # rescaled = img_as_ubyte(self.hist_match(rolled, template))
 
             # rolled = exposure.adjust_gamma(rolled, 1.25)
-            rescaled = exposure.rescale_intensity(rolled, in_range=(1, 255))
             rescaled = img_as_ubyte(exposure.equalize_adapthist(rolled))
             # rescaled = correct(rolled)
             # rescaled = img_as_ubyte(exposure.adjust_sigmoid(rolled, 0.25, 10))
 
-            unrolled = np.rollaxis(rescaled, 2)
+            unrolled = np.moveaxis(rescaled, -1, 0)
 
             with rasterio.open('%s/color_corrected.tif' % self.output_dir, 'w', **profile) as f:
                 f.write(unrolled)
 
+        self._invalidate_dir_entries()
+
+    def _mark_done(self):
+        """
+        Write the done marker. It is written under a temporary name and
+        renamed so a partial marker is never seen.
+        """
+        marker_path = done_marker_path(self.output_dir, self.scene_id)
+        tmp_path = '%s.tmp' % marker_path
+
+        with open(tmp_path, 'w') as f:
+            f.write('')
+
+        os.rename(tmp_path, marker_path)
+
+    @classmethod
+    def create_pool(cls, workers=None):
+        """
+        Create the worker processes for :meth:`process_many`. Create it
+        before starting any threads: forking while other threads hold locks
+        can deadlock the workers.
+
+        More workers process more scenes at once, but each holds a whole
+        scene in memory. By default the count is capped by physical memory;
+        pass ``workers`` to trade speed against peak memory yourself.
+        """
+        if workers is None:
+            workers = _default_workers()
+
+        return Pool(workers, _init_worker, (max(1, cpu_count() // workers),))
+
+    @classmethod
+    def process_many(cls, scenes, pool):
+        """
+        Process scenes on a pool from :meth:`create_pool`. ``scenes`` can be
+        any iterable, including one that yields scenes as their downloads
+        finish; each is handed to a worker as soon as it arrives.
+        """
+        for _ in pool.imap_unordered(_process_scene, scenes):
+            pass
+
     def process(self):
         print('{s.year} {s.day} {s.path} {s.row}'.format(s=self.scene_id))
 
+        if os.path.exists(done_marker_path(self.output_dir, self.scene_id)):
+            return
+
         try:
             self.download()
             self.unzip()
             self.project_bands()
-            self.merge_bands()
-            self.crop()
             self.color_correct()
-        except Failure as e:
+            self._mark_done()
+        except (CalledProcessError, tarfile.TarError) as e:
             print(str(e))